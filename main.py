@@ -1,58 +1,340 @@
 # main.py
+import asyncio
+import os
+import re
+import time
+from contextlib import asynccontextmanager
+from typing import Any, Dict, Optional
+
+from cachetools import LRUCache, TTLCache
 from fastapi import FastAPI, Request, Response
-from fastapi.responses import HTMLResponse, RedirectResponse
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import HTMLResponse, RedirectResponse, StreamingResponse
 import httpx
-
-app = FastAPI()
+import msgspec
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, Histogram, generate_latest
+from starlette.background import BackgroundTask
+from tenacity import (
+    AsyncRetrying,
+    retry_if_exception,
+    stop_after_attempt,
+    wait_exponential_jitter,
+)
+
+# 有 uvloop 时使用 uvloop 事件循环（Windows 不支持，回退到默认的 asyncio）
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+else:
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
 
 # 配置
 NPM_REGISTRY = "https://registry.npmjs.org"
 JSDELIVR_CDN = "https://cdn.jsdelivr.net/npm"
 UNPKG_CDN = "https://unpkg.com"
 
+# 文件获取方式："proxy" 由本服务转发文件内容；"redirect" 只探测可用的 CDN 后 307 重定向过去
+PROXY_MODE = os.environ.get("PROXY_MODE", "proxy")
+
+# 对冲请求：备用 CDN 延迟多久发出（秒），主 CDN 通常能在此之前返回
+# 运行时每分钟按 jsDelivr 最近的 p50 延迟调整，HEDGE_DELAY 只是初始值
+HEDGE_DELAY = 0.15
+HEDGE_DELAY_MIN = 0.05
+HEDGE_DELAY_MAX = 1.0
+HEDGE_TUNE_INTERVAL = 60
+
+# 各 CDN 返回响应头的耗时（每个 worker 单独统计）
+# 使用独立的 registry：以 python main.py 多 worker 启动时，子进程会把本文件导入两次
+METRICS_REGISTRY = CollectorRegistry()
+CDN_LATENCY = Histogram(
+    "cdn_latency_seconds",
+    "Time until the CDN returns response headers",
+    ["host"],
+    buckets=(0.025, 0.05, 0.075, 0.1, 0.15, 0.2, 0.3, 0.5, 0.75, 1.0, 2.0, 5.0),
+    registry=METRICS_REGISTRY
+)
+
+# 对 npm registry 的最大并发请求数（每个 worker），超出的请求排队等待
+NPM_CONCURRENCY = 64
+
+# 预热请求的超时（秒），预热只是尽力而为，不能拖慢启动
+WARMUP_TIMEOUT = 3.0
+
+# 上游连接池：保持更多、更久的空闲连接，减少重新解析 DNS 和握手
+UPSTREAM_LIMITS = httpx.Limits(
+    max_connections=100,
+    max_keepalive_connections=50,
+    keepalive_expiry=120.0
+)
+
+# 缓存策略：精确版本号的文件不可变，可长期缓存；latest/dist-tag 只短时缓存
+IMMUTABLE_CACHE = "public, max-age=31536000, immutable"
+SHORT_CACHE = "public, max-age=60"
+EXACT_VERSION = re.compile(r"\d+\.\d+\.\d+(?:-[0-9A-Za-z.-]+)?(?:\+[0-9A-Za-z.-]+)?")
+
+
+class PackageVersion(msgspec.Struct):
+    """
+    单个版本 package.json 中用到的字段，解码时忽略其余字段
+    入口相关字段的格式五花八门（例如 exports 可以是数组），不在解码时校验，
+    由 resolve_entry_file 判断类型，避免格式不符时整个请求失败
+    """
+    version: Optional[str] = None
+    jsdelivr: Any = None
+    main: Any = None
+    exports: Any = None
+
+
+class Packument(msgspec.Struct):
+    """
+    完整包信息中用到的字段：dist-tags 和各版本的入口字段
+    完整包信息可达数 MB（含 README、依赖等），只保留这些字段再放进缓存
+    """
+    dist_tags: Dict[str, Any] = msgspec.field(default_factory=dict, name="dist-tags")
+    versions: Dict[str, PackageVersion] = msgspec.field(default_factory=dict)
+
+
+# 包信息缓存：TTL 内直接命中；过期后保留 ETag 用于条件请求
+_pkg_cache = TTLCache(maxsize=2048, ttl=300)
+
+# 条件请求缓存 {路径: (etag, 文档, 响应字节数)}，按响应体总字节数限制大小
+# 超过 PKG_ETAG_MAX_ITEM_BYTES 的文档（如大型完整包信息）不保留，过期后重新下载
+PKG_ETAG_MAX_BYTES = 64 * 1024 * 1024
+PKG_ETAG_MAX_ITEM_BYTES = 1024 * 1024
+_pkg_etags = LRUCache(maxsize=PKG_ETAG_MAX_BYTES, getsizeof=lambda item: item[2])
+_pkg_inflight = {}
+
+# 入口文件缓存：npm 已发布的版本不可变，按 (包名, 版本) 缓存解析结果，无需 TTL
+_entry_cache = LRUCache(maxsize=8192)
 
-def resolve_entry_file(package_json: dict) -> str:
+
+async def warmup(client: httpx.AsyncClient, urls: list):
+    """向上游发送 HEAD 请求预热连接，失败不影响启动"""
+    for url in urls:
+        try:
+            await client.head(url, timeout=WARMUP_TIMEOUT)
+        except httpx.HTTPError:
+            continue
+
+
+async def warmup_upstreams(app: FastAPI):
+    """同时预热 npm registry 和各 CDN 的连接"""
+    await asyncio.gather(
+        warmup(app.state.npm_client, ["/"]),
+        warmup(app.state.cdn_client, [JSDELIVR_CDN, UNPKG_CDN])
+    )
+
+
+def is_retryable_error(error: BaseException) -> bool:
+    """网络错误、超时、429 和 5xx 可以重试，其余错误直接抛出"""
+    if isinstance(error, httpx.TransportError):
+        return True
+    if isinstance(error, httpx.HTTPStatusError):
+        status_code = error.response.status_code
+        return status_code == 429 or status_code >= 500
+    return False
+
+
+async def npm_get(state, path: str, headers: dict) -> httpx.Response:
+    """
+    向 npm registry 发送 GET 请求
+    通过信号量限制并发数，临时性错误按指数退避重试最多 3 次
+    """
+    async for attempt in AsyncRetrying(
+            stop=stop_after_attempt(3),
+            wait=wait_exponential_jitter(initial=0.2, max=2),
+            retry=retry_if_exception(is_retryable_error),
+            reraise=True
+    ):
+        with attempt:
+            async with state.npm_sem:
+                response = await state.npm_client.get(f"/{path}", headers=headers)
+
+            if response.status_code == 429 or response.status_code >= 500:
+                response.raise_for_status()
+
+    return response
+
+
+async def load_pkg(state, path: str, doc_type: type):
+    """
+    请求 registry 并写入缓存；缓存过期时带上 ETag 做条件请求
+    响应直接解码为 doc_type 对应的 msgspec.Struct，只保留用到的字段
+    """
+    headers = {}
+    cached = _pkg_etags.get(path)
+    if cached:
+        headers["If-None-Match"] = cached[0]
+
+    response = await npm_get(state, path, headers)
+
+    if response.status_code == 404:
+        return None
+
+    if response.status_code == 304 and cached:
+        package_data = cached[1]
+    else:
+        response.raise_for_status()
+        package_data = msgspec.json.decode(response.content, type=doc_type)
+        etag = response.headers.get("etag")
+        size = len(response.content)
+        if etag and size <= PKG_ETAG_MAX_ITEM_BYTES:
+            _pkg_etags[path] = (etag, package_data, size)
+
+    _pkg_cache[path] = package_data
+    return package_data
+
+
+async def fetch_pkg(state, path: str, doc_type: type = Packument):
+    """
+    获取 npm registry 中的文档（完整包信息或单个版本），带缓存
+    path 为包名或 "包名/版本"，不存在时返回 None
+    """
+    # 只查一次缓存，避免判断和读取之间条目恰好过期
+    package_data = _pkg_cache.get(path)
+    if package_data is not None:
+        return package_data
+
+    # 合并并发请求：同一路径只发一次请求，其余调用方等待同一个结果
+    future = _pkg_inflight.get(path)
+    if future is None:
+        future = asyncio.ensure_future(load_pkg(state, path, doc_type))
+        _pkg_inflight[path] = future
+        # 所有调用方都被取消时没人读取结果，这里取出异常，避免 "exception was never retrieved" 日志
+        future.add_done_callback(
+            lambda f: (_pkg_inflight.pop(path, None), f.cancelled() or f.exception())
+        )
+
+    # shield：某个调用方被取消时不影响其他等待者
+    return await asyncio.shield(future)
+
+
+async def fetch_version(state, package_name: str, version: str = None):
+    """
+    获取单个版本的 package.json（/{包名}/{版本}），只有几 KB，比完整包信息小得多
+    version 为空时取 latest；包或版本不存在时返回 None
+    """
+    return await fetch_pkg(state, f"{package_name}/{version or 'latest'}", PackageVersion)
+
+
+def cdn_latency_buckets(host: str) -> dict:
+    """读取某个 CDN 延迟直方图的累计桶计数 {上界: 次数}"""
+    buckets = {}
+    for metric in CDN_LATENCY.collect():
+        for sample in metric.samples:
+            if sample.name.endswith("_bucket") and sample.labels["host"] == host:
+                buckets[float(sample.labels["le"])] = sample.value
+    return buckets
+
+
+def estimate_p50(current: dict, previous: dict):
+    """根据两次采样之间新增的桶计数估算 p50（取所在桶的上界），没有新数据时返回 None"""
+    total = current.get(float("inf"), 0) - previous.get(float("inf"), 0)
+    if total <= 0:
+        return None
+
+    for upper_bound in sorted(current):
+        if current[upper_bound] - previous.get(upper_bound, 0) >= total / 2:
+            return upper_bound
+    return None
+
+
+async def tune_hedge_delay(app: FastAPI):
+    """每分钟用 jsDelivr 最近一分钟的 p50 延迟作为对冲等待时间"""
+    host = httpx.URL(JSDELIVR_CDN).host
+    previous = cdn_latency_buckets(host)
+
+    while True:
+        await asyncio.sleep(HEDGE_TUNE_INTERVAL)
+        current = cdn_latency_buckets(host)
+        p50 = estimate_p50(current, previous)
+        previous = current
+
+        if p50 is not None:
+            app.state.hedge_delay = min(max(p50, HEDGE_DELAY_MIN), HEDGE_DELAY_MAX)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """启动时创建共享的 httpx 客户端（复用连接），关闭时释放"""
+    app.state.npm_client = httpx.AsyncClient(
+        base_url=NPM_REGISTRY,
+        timeout=30.0,
+        transport=httpx.AsyncHTTPTransport(retries=2, http2=True, limits=UPSTREAM_LIMITS)
+    )
+    app.state.npm_sem = asyncio.Semaphore(NPM_CONCURRENCY)
+    app.state.cdn_client = httpx.AsyncClient(
+        timeout=15.0,
+        transport=httpx.AsyncHTTPTransport(retries=2, http2=True, limits=UPSTREAM_LIMITS),
+        follow_redirects=True
+    )
+
+    # 预热：提前完成 DNS 解析和 TLS/HTTP2 握手，避免首个用户请求承担这部分开销
+    # 在后台进行，上游缓慢或不可达时也不阻塞启动
+    warmer = asyncio.create_task(warmup_upstreams(app))
+
+    app.state.hedge_delay = HEDGE_DELAY
+    tuner = asyncio.create_task(tune_hedge_delay(app))
+
+    try:
+        yield
+    finally:
+        warmer.cancel()
+        tuner.cancel()
+        await app.state.npm_client.aclose()
+        await app.state.cdn_client.aclose()
+
+
+app = FastAPI(lifespan=lifespan)
+
+# 压缩未编码的文本响应；上游已压缩的响应带有 Content-Encoding，中间件会直接跳过
+app.add_middleware(GZipMiddleware, minimum_size=1024)
+
+
+def resolve_entry_file(package_json: PackageVersion) -> str:
     """
     解析包的入口文件路径
     按照优先级：jsdelivr > exports["."]["default"] > exports["."]字符串 > main
     如果都不存在则返回 None
     """
-    # 1. 检查 jsdelivr 字段
-    if "jsdelivr" in package_json:
-        entry = package_json["jsdelivr"]
-        return entry.lstrip("./")
-
-    # 2. 检查 exports["."]
-    if "exports" in package_json:
-        exports = package_json["exports"]
-
-        if isinstance(exports, dict) and "." in exports:
-            dot_export = exports["."]
-
-            # 2.1 如果 exports["."] 是对象，检查 "default" 字段
-            if isinstance(dot_export, dict):
-                if "default" in dot_export:
-                    entry = dot_export["default"]
-                    return entry.lstrip("./")
-                # 如果是对象但没有 default，继续检查 main
-
-            # 2.2 如果 exports["."] 是字符串，直接使用
-            elif isinstance(dot_export, str):
-                return dot_export.lstrip("./")
-
-    # 3. 回退到 main 字段
-    if "main" in package_json:
-        entry = package_json["main"]
-        return entry.lstrip("./")
+    # 1. jsdelivr 字段 > 2. exports["."] > 3. main 字段，只接受非空字符串
+    candidates = (package_json.jsdelivr, resolve_dot_export(package_json.exports), package_json.main)
+    for entry in candidates:
+        if type(entry) is str and entry:
+            return entry.lstrip("./")
 
     # 4. 所有条件都不满足，返回 None
     return None
 
 
-@app.get("/")
-async def root():
-    """根路径返回简单的 HTML 页面"""
-    html_content = """
+def resolve_dot_export(exports) -> str:
+    """从 exports["."] 中取入口：对象取 "default"，字符串直接使用"""
+    if type(exports) is not dict:
+        return None
+
+    dot_export = exports.get(".")
+    if type(dot_export) is dict:
+        return dot_export.get("default")
+    if type(dot_export) is str:
+        return dot_export
+    return None
+
+
+# 常用错误响应的内容，模块加载时编码一次
+NOT_FOUND = b"404 Not Found"
+PACKAGE_NOT_FOUND = b"404 Package Not Found"
+PACKAGE_NOT_FOUND_HTML = b"<h1>404 Package Not Found</h1>"
+VERSION_NOT_FOUND = b"404 Version %s Not Found"
+VERSION_NOT_FOUND_HTML = b"<h1>404 Version %s Not Found</h1>"
+FILE_NOT_FOUND = b"404 File Not Found"
+NO_LATEST_VERSION_HTML = b"<h1>Error: Cannot find latest version</h1>"
+BAD_GATEWAY = b"502 Bad Gateway"
+GATEWAY_TIMEOUT = b"504 Gateway Timeout"
+
+
+# 根路径页面，模块加载时编码一次
+ROOT_HTML = """
     <!DOCTYPE html>
     <html>
     <head>
@@ -70,217 +352,366 @@ async def root():
         </ul>
     </body>
     </html>
-    """
-    return HTMLResponse(content=html_content)
+    """.encode("utf-8")
 
 
-@app.get("/{full_path:path}")
-async def handle_request(full_path: str, request: Request):
-    """统一处理所有请求"""
+# 目录页面模板，模块加载时构建一次
+DIRECTORY_HTML = """<!DOCTYPE HTML>
+<html>
+<head>
+<meta charset="utf-8">
+<title>{name}</title>
+</head>
+<body>
+<h1>{name}</h1>
+<hr>
+<ul>
+{links}</ul>
+<hr>
+</body>
+</html>"""
 
-    # 情况1: 包名（不含@符号和/） - 例如 /react
-    if "@" not in full_path and not full_path.endswith("/"):
-        return await get_package_entry(full_path, None)
+# 简单的文件列表
+DIRECTORY_FILES = ["index.js", "package.json", "README.md"]
+DIRECTORY_LINKS = "".join(
+    f'<li><a href="{file_name}">{file_name}</a></li>\n' for file_name in DIRECTORY_FILES
+)
 
-    # 情况2: 包名/ （不含@符号，以/结尾） - 例如 /vue/
-    if "@" not in full_path and full_path.endswith("/"):
-        package_name = full_path.rstrip("/")
 
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            try:
-                response = await client.get(f"{NPM_REGISTRY}/{package_name}")
-
-                if response.status_code == 404:
-                    return HTMLResponse(
-                        content="<h1>404 Package Not Found</h1>",
-                        status_code=404
-                    )
-
-                package_data = response.json()
-                latest_version = package_data.get("dist-tags", {}).get("latest")
-
-                if latest_version:
-                    return RedirectResponse(url=f"/{package_name}@{latest_version}/")
-                else:
-                    return HTMLResponse(
-                        content="<h1>Error: Cannot find latest version</h1>",
-                        status_code=500
-                    )
-
-            except Exception as e:
-                return HTMLResponse(
-                    content=f"<h1>Error: {str(e)}</h1>",
-                    status_code=500
-                )
+@app.get("/")
+async def root():
+    """根路径返回简单的 HTML 页面"""
+    return HTMLResponse(content=ROOT_HTML)
+
+
+# npm 包名不能以 _ 开头，/_metrics 不会和任何包冲突
+@app.get("/_metrics")
+async def metrics():
+    """Prometheus 指标（当前 worker）"""
+    return Response(content=generate_latest(METRICS_REGISTRY), headers={"Content-Type": CONTENT_TYPE_LATEST})
+
+
+@app.exception_handler(httpx.TimeoutException)
+async def upstream_timeout_handler(request: Request, exc: httpx.TimeoutException):
+    """上游请求超时"""
+    return Response(content=GATEWAY_TIMEOUT, status_code=504)
+
+
+@app.exception_handler(httpx.HTTPError)
+async def upstream_error_handler(request: Request, exc: httpx.HTTPError):
+    """上游请求失败（网络错误或 5xx 等）"""
+    return Response(content=BAD_GATEWAY, status_code=502)
+
+
+# 路由按顺序匹配，带 @ 的路由必须注册在 /{package_name} 之前
 
-    # 情况3: 包名@版本（不以/结尾） - 例如 /vue@3.3.4
-    if "@" in full_path and "/" not in full_path.split("@", 1)[1]:
-        parts = full_path.split("@", 1)
-        package_name = parts[0]
-        version = parts[1]
-        return await get_package_entry(package_name, version)
+# 情况4: 包名@版本/ - 例如 /vue@3.3.4/
+@app.get("/{package_name}@{version}/")
+async def package_directory(request: Request, package_name: str, version: str):
+    return await get_package_directory(request, package_name, version)
 
-    # 情况4: 包名@版本/ - 例如 /vue@3.3.4/
-    if full_path.endswith("/"):
-        parts = full_path.rstrip("/").split("@", 1)
-        if len(parts) == 2:
-            package_name = parts[0]
-            version = parts[1]
-            return await get_package_directory(package_name, version)
 
-    # 情况5: 包名@版本/文件路径 - 例如 /vue@3.3.4/dist/vue.runtime.esm-browser.js
-    if "@" in full_path:
-        parts = full_path.split("@", 1)
-        package_name = parts[0]
+# 情况5: 包名@版本/文件路径 - 例如 /vue@3.3.4/dist/vue.runtime.esm-browser.js
+@app.get("/{package_name}@{version}/{file_path:path}")
+async def package_file(request: Request, package_name: str, version: str, file_path: str):
+    # 不支持浏览子目录
+    if file_path.endswith("/"):
+        return Response(content=NOT_FOUND, status_code=404)
 
-        if "/" in parts[1]:
-            version_and_path = parts[1].split("/", 1)
-            version = version_and_path[0]
-            file_path = version_and_path[1]
-            return await get_package_file(package_name, version, file_path)
+    immutable = EXACT_VERSION.fullmatch(version) is not None
+    return await get_package_file(request, package_name, version, file_path, immutable)
+
+
+# 情况3: 包名@版本（不以/结尾） - 例如 /vue@3.3.4
+@app.get("/{package_name}@{version}")
+async def package_version_entry(request: Request, package_name: str, version: str):
+    return await get_package_entry(request, package_name, version)
+
+
+# 情况2: 包名/ （不含@符号，以/结尾） - 例如 /vue/
+@app.get("/{package_name}/")
+async def package_latest_directory(request: Request, package_name: str):
+    if "@" in package_name:
+        return Response(content=NOT_FOUND, status_code=404)
+
+    return await redirect_to_latest(request, package_name)
+
+
+# 情况1: 包名（不含@符号和/） - 例如 /react
+@app.get("/{package_name}")
+async def package_entry(request: Request, package_name: str):
+    if "@" in package_name:
+        return Response(content=NOT_FOUND, status_code=404)
+
+    return await get_package_entry(request, package_name, None)
+
+
+# 其余路径都不支持
+@app.get("/{full_path:path}")
+async def not_found(full_path: str):
+    return Response(content=NOT_FOUND, status_code=404)
 
-    return Response(content="404 Not Found", status_code=404)
 
+async def redirect_to_latest(request: Request, package_name: str):
+    """重定向到最新版本的目录页面"""
+    state = request.app.state
 
-async def get_package_entry(package_name: str, version: str = None):
+    version_data = await fetch_version(state, package_name)
+
+    # /latest 不存在时回退到完整包信息，区分“包不存在”和“没有 latest”
+    if version_data is None and await fetch_pkg(state, package_name) is None:
+        return HTMLResponse(
+            content=PACKAGE_NOT_FOUND_HTML,
+            status_code=404
+        )
+
+    latest_version = version_data.version if version_data else None
+
+    if latest_version:
+        return RedirectResponse(
+            url=f"/{package_name}@{latest_version}/",
+            headers={"Cache-Control": SHORT_CACHE}
+        )
+    else:
+        return HTMLResponse(
+            content=NO_LATEST_VERSION_HTML,
+            status_code=500
+        )
+
+
+async def get_package_entry(request: Request, package_name: str, version: str = None):
     """获取包的入口文件内容"""
-    async with httpx.AsyncClient(timeout=30.0) as client:
-        try:
-            response = await client.get(f"{NPM_REGISTRY}/{package_name}")
+    state = request.app.state
+
+    # 已发布版本不可变，命中缓存时直接获取文件，无需访问 registry
+    key = (package_name, version)
+    if key in _entry_cache:
+        entry_file = _entry_cache[key]
+    else:
+        # 只获取该版本的 package.json（未指定版本时为 latest）
+        version_data = await fetch_version(state, package_name, version)
 
-            if response.status_code == 404:
+        if version_data is None:
+            # 回退到完整包信息，区分“包不存在”和“版本不存在”
+            package_data = await fetch_pkg(state, package_name)
+
+            if package_data is None:
                 return Response(
-                    content="404 Package Not Found",
+                    content=PACKAGE_NOT_FOUND,
                     status_code=404
                 )
 
-            package_data = response.json()
-
             # 如果没有指定版本，使用最新版本
             if not version:
-                version = package_data.get("dist-tags", {}).get("latest")
+                version = package_data.dist_tags.get("latest")
 
             # 检查版本是否存在
-            if version not in package_data.get("versions", {}):
+            if version not in package_data.versions:
                 return Response(
-                    content=f"404 Version {version} Not Found",
+                    content=VERSION_NOT_FOUND % str(version).encode("utf-8"),
                     status_code=404
                 )
 
-            # 获取该版本的 package.json
-            version_data = package_data["versions"][version]
+            version_data = package_data.versions[version]
 
-            # 解析入口文件路径
-            entry_file = resolve_entry_file(version_data)
+        # 使用实际版本号（version 可能为空或是 dist-tag）
+        version = version_data.version or version
 
-            # 如果无法解析入口文件，返回 404
-            if entry_file is None:
-                return Response(
-                    content="404 Not Found",
-                    status_code=404
-                )
+        # 解析入口文件路径
+        entry_file = resolve_entry_file(version_data)
 
-            # 获取入口文件内容
-            return await get_package_file(package_name, version, entry_file)
+        # 只缓存精确版本号，dist-tag 指向的版本会变化
+        if key[1] == version:
+            _entry_cache[key] = entry_file
 
-        except Exception as e:
-            return Response(
-                content=f"Error: {str(e)}",
-                status_code=500
-            )
+    # 如果无法解析入口文件，返回 404
+    if entry_file is None:
+        return Response(
+            content=NOT_FOUND,
+            status_code=404
+        )
+
+    # 获取入口文件内容
+    immutable = key[1] is not None and EXACT_VERSION.fullmatch(key[1]) is not None
+    return await get_package_file(request, package_name, version, entry_file, immutable)
 
 
-async def get_package_directory(package_name: str, version: str):
+async def get_package_directory(request: Request, package_name: str, version: str):
     """返回包的目录列表页面"""
-    async with httpx.AsyncClient(timeout=30.0) as client:
-        try:
-            response = await client.get(f"{NPM_REGISTRY}/{package_name}")
+    state = request.app.state
 
-            if response.status_code == 404:
-                return HTMLResponse(
-                    content="<h1>404 Package Not Found</h1>",
-                    status_code=404
-                )
+    version_data = await fetch_version(state, package_name, version)
 
-            package_data = response.json()
+    if version_data is None:
+        # 回退到完整包信息，区分“包不存在”和“版本不存在”
+        package_data = await fetch_pkg(state, package_name)
 
-            if version not in package_data.get("versions", {}):
-                return HTMLResponse(
-                    content=f"<h1>404 Version {version} Not Found</h1>",
-                    status_code=404
-                )
+        if package_data is None:
+            return HTMLResponse(
+                content=PACKAGE_NOT_FOUND_HTML,
+                status_code=404
+            )
 
-            # 简单的文件列表
-            files = ["index.js", "package.json", "README.md"]
+        if version not in package_data.versions:
+            return HTMLResponse(
+                content=VERSION_NOT_FOUND_HTML % version.encode("utf-8"),
+                status_code=404
+            )
 
-            file_links = ""
-            for file_name in files:
-                file_links += f'<li><a href="{file_name}">{file_name}</a></li>\n'
+    html_content = DIRECTORY_HTML.format(name=package_name, links=DIRECTORY_LINKS)
 
-            html_content = f"""<!DOCTYPE HTML>
-<html>
-<head>
-<meta charset="utf-8">
-<title>{package_name}</title>
-</head>
-<body>
-<h1>{package_name}</h1>
-<hr>
-<ul>
-{file_links}</ul>
-<hr>
-</body>
-</html>"""
+    return HTMLResponse(content=html_content)
 
-            return HTMLResponse(content=html_content)
 
-        except Exception as e:
-            return HTMLResponse(
-                content=f"<h1>Error: {str(e)}</h1>",
-                status_code=500
-            )
+async def open_cdn_stream(client: httpx.AsyncClient, cdn_url: str, delay: float = 0,
+                          headers: dict = None, method: str = "GET"):
+    """
+    延迟 delay 秒后以流的方式请求 CDN
+    返回 404 时关闭连接并返回 None，其余非 200 状态（429、5xx 等）抛出 HTTPStatusError
+    """
+    if delay:
+        await asyncio.sleep(delay)
+
+    cdn_request = client.build_request(method, cdn_url, headers=headers)
+    start = time.perf_counter()
+    try:
+        response = await client.send(cdn_request, stream=True)
+    finally:
+        # 输掉对冲被取消或出错的请求也要记录（记为“至少这么慢”），
+        # 否则只统计到较快的样本，p50 和对冲等待时间会被不断压低
+        CDN_LATENCY.labels(host=cdn_request.url.host).observe(time.perf_counter() - start)
+
+    if response.status_code != 200:
+        await response.aclose()
+        if response.status_code == 404:
+            return None
+        raise httpx.HTTPStatusError(
+            f"CDN returned {response.status_code}",
+            request=cdn_request,
+            response=response
+        )
+
+    return response
+
 
+async def cancel_cdn_streams(tasks: list, winner):
+    """取消未完成的 CDN 请求，并关闭除 winner 之外已经打开的响应"""
+    for task in tasks:
+        if not task.done():
+            task.cancel()
+        elif not task.cancelled() and task.exception() is None:
+            response = task.result()
+            if response is not None and response is not winner:
+                await response.aclose()
 
-async def get_package_file(package_name: str, version: str, file_path: str):
-    """获取指定版本包的具体文件"""
+
+async def get_package_file(request: Request, package_name: str, version: str, file_path: str,
+                           immutable: bool = False):
+    """
+    获取指定版本包的具体文件
+    immutable 为 True 表示请求地址中是精确版本号，响应可以被长期缓存
+    """
     cdn_urls = [
         f"{JSDELIVR_CDN}/{package_name}@{version}/{file_path}",
         f"{UNPKG_CDN}/{package_name}@{version}/{file_path}",
     ]
 
-    transport = httpx.AsyncHTTPTransport(retries=2)
-    async with httpx.AsyncClient(
-            timeout=15.0,
-            transport=transport,
-            follow_redirects=True
-    ) as client:
+    client = request.app.state.cdn_client
 
-        for cdn_url in cdn_urls:
-            try:
-                response = await client.get(cdn_url)
+    # 按客户端支持的压缩格式请求 CDN，已压缩的内容原样转发，避免解压再压缩
+    cdn_headers = {"Accept-Encoding": request.headers.get("accept-encoding", "identity")}
 
-                if response.status_code == 200:
-                    content_type = response.headers.get("content-type", "text/plain")
+    # 重定向模式只需要 HEAD 探测文件是否存在
+    method = "HEAD" if PROXY_MODE == "redirect" else "GET"
 
-                    return Response(
-                        content=response.content,
-                        media_type=content_type,
-                        headers={
-                            "Content-Type": content_type,
-                            "Access-Control-Allow-Origin": "*"
-                        }
-                    )
+    # 同时向多个 CDN 发起请求（备用 CDN 稍晚发出），取第一个成功的响应
+    hedge_delay = request.app.state.hedge_delay
+    tasks = [
+        asyncio.create_task(open_cdn_stream(client, cdn_url, i * hedge_delay, cdn_headers, method))
+        for i, cdn_url in enumerate(cdn_urls)
+    ]
+    response = None
+    not_found = False
+    last_error = None
 
-            except Exception:
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            try:
+                response = await next_done
+            except httpx.HTTPError as e:
+                last_error = e
                 continue
 
+            if response is not None:
+                break
+            not_found = True
+    finally:
+        await cancel_cdn_streams(tasks, response)
+
+    # 只有 CDN 确实返回了 404 才返回 404；
+    # 全部失败（超时、连接失败、429、5xx 等）时交给异常处理器返回 502/504
+    if response is None and not not_found and last_error is not None:
+        raise last_error
+
+    if response is None:
         return Response(
-            content="404 File Not Found",
+            content=FILE_NOT_FOUND,
             status_code=404
         )
 
+    if PROXY_MODE == "redirect":
+        # 让客户端直接从 CDN 下载，本服务不再转发文件内容
+        await response.aclose()
+        return RedirectResponse(
+            url=str(response.request.url),
+            status_code=307,
+            headers={
+                "Access-Control-Allow-Origin": "*",
+                "Cache-Control": IMMUTABLE_CACHE if immutable else SHORT_CACHE
+            }
+        )
+
+    content_type = response.headers.get("content-type", "text/plain")
+
+    headers = {
+        "Content-Type": content_type,
+        "Access-Control-Allow-Origin": "*",
+        "Cache-Control": IMMUTABLE_CACHE if immutable else SHORT_CACHE
+    }
+
+    # 透传上游的压缩格式和校验信息，方便浏览器和中间缓存做条件请求
+    for name in ("content-encoding", "etag", "last-modified"):
+        value = response.headers.get(name)
+        if value:
+            headers[name] = value
+
+    if "content-encoding" in headers:
+        # 上游已压缩，GZipMiddleware 不会再处理，需要自己声明 Vary
+        headers["Vary"] = "Accept-Encoding"
+    elif "etag" in headers and not headers["etag"].startswith("W/"):
+        # 未压缩的内容可能被 GZipMiddleware 压缩，字节不再一致，强 ETag 改为弱 ETag
+        headers["etag"] = "W/" + headers["etag"]
+
+    return StreamingResponse(
+        response.aiter_raw(),
+        status_code=200,
+        media_type=content_type,
+        headers=headers,
+        background=BackgroundTask(response.aclose)
+    )
+
 
 if __name__ == "__main__":
     import uvicorn
 
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    # 多进程运行，每个 worker 在 lifespan 中创建自己的连接池
+    # 生产环境也可以使用：gunicorn -k uvicorn.workers.UvicornWorker main:app
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=8000,
+        loop="uvloop" if uvloop else "asyncio",
+        http="httptools",
+        workers=max(2, os.cpu_count() or 1),
+        log_level="warning"
+    )